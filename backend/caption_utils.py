@@ -1,103 +1,160 @@
+from concurrent.futures import ThreadPoolExecutor
 import ffmpeg
+import hashlib
+import numpy as np
+import os
 from pathlib import Path
 import speech_recognition as sr
-from pydub import AudioSegment
-from pydub.silence import split_on_silence
+import sqlite3
+import threading
+import time
 
 
-def extract_audio(video_path: Path, output_dir: Path) -> Path:
-    audio_path = output_dir / "audio.wav"
+SAMPLE_RATE = 16000
+SAMPLE_WIDTH = 2  # 16-bit PCM
 
-    (
+# Concurrent Google Speech requests per video
+RECOGNITION_WORKERS = 16
+
+# Recognized text keyed by sha256 of the chunk PCM, shared across sessions.
+# Opened by the app with open_recognition_cache(), recognition is not cached until then.
+_cache_lock = threading.Lock()
+_cache_conn = None
+
+# Set VIDEO_ENCODER=h264_nvenc on hosts with an NVIDIA GPU and an NVENC-enabled ffmpeg
+VIDEO_ENCODER = os.getenv("VIDEO_ENCODER", "libx264")
+
+
+def extract_audio(video_path: Path) -> np.ndarray:
+    # Decode straight to mono 16 kHz PCM on stdout instead of writing a WAV to disk
+    raw, _ = (
         ffmpeg.input(str(video_path))
-        .output(str(audio_path), ac=1, ar="16000")
-        .overwrite_output()
-        .run(quiet=True)
+        .output("pipe:", format="s16le", ac=1, ar=str(SAMPLE_RATE))
+        .run(capture_stdout=True, quiet=True)
     )
 
-    return audio_path
+    return np.frombuffer(raw, dtype=np.int16)
+
+
+def open_recognition_cache(db_path: Path) -> None:
+    """Open (or create) the sqlite file that caches recognized text"""
+    global _cache_conn
+    with _cache_lock:
+        _cache_conn = sqlite3.connect(str(db_path), check_same_thread=False)
+        _cache_conn.execute(
+            "CREATE TABLE IF NOT EXISTS recognized_chunks (key BLOB PRIMARY KEY, text TEXT NOT NULL, created REAL NOT NULL)"
+        )
+
+
+def purge_recognition_cache(max_age_seconds: float) -> None:
+    """Drop cached text older than max_age_seconds, so transcripts don't outlive their session"""
+    with _cache_lock:
+        if _cache_conn is None:
+            return
+        _cache_conn.execute("DELETE FROM recognized_chunks WHERE created < ?", (time.time() - max_age_seconds,))
+        _cache_conn.commit()
 
 
-def generate_subtitles(audio_path: Path, output_dir: Path) -> Path:
+def _safe_recognize(recognizer: sr.Recognizer, audio_data: sr.AudioData) -> str:
+    """Recognize one chunk, returning an empty string when nothing usable comes back"""
+    # Reruns of the same video send identical PCM, so reuse earlier results
+    key = hashlib.sha256(audio_data.frame_data).digest()
+    with _cache_lock:
+        if _cache_conn is not None:
+            row = _cache_conn.execute("SELECT text FROM recognized_chunks WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                return row[0]
+    
+    try:
+        text = recognizer.recognize_google(audio_data)
+    except sr.UnknownValueError:
+        # Speech not recognized in this chunk, skip
+        text = ""
+    except sr.RequestError as e:
+        # Don't cache failed requests, they may succeed next time
+        print(f"Could not request results from Google Speech Recognition; {e}")
+        return ""
+    
+    with _cache_lock:
+        if _cache_conn is not None:
+            _cache_conn.execute(
+                "INSERT OR REPLACE INTO recognized_chunks (key, text, created) VALUES (?, ?, ?)",
+                (key, text, time.time())
+            )
+            _cache_conn.commit()
+    return text
+
+
+def generate_subtitles(video_path: Path, output_dir: Path) -> Path:
     srt_path = output_dir / "subtitles.srt"
     recognizer = sr.Recognizer()
+    pcm = extract_audio(video_path)
     
     try:
-        # Load audio file
-        audio = AudioSegment.from_wav(str(audio_path))
-        total_duration = len(audio) / 1000.0  # Total duration in seconds
+        total_duration = len(pcm) / SAMPLE_RATE  # Total duration in seconds
         
         # Split audio into smaller 3-second chunks for better sync
-        chunk_length_ms = 3000  # 3 seconds per chunk
+        chunk_length = 3 * SAMPLE_RATE  # 3 seconds per chunk, in samples
         chunks = []
         
-        for i in range(0, len(audio), chunk_length_ms):
-            chunk = audio[i:i + chunk_length_ms]
-            chunks.append((i / 1000.0, chunk))  # Store start time with chunk
+        for i in range(0, len(pcm), chunk_length):
+            chunk = pcm[i:i + chunk_length]  # numpy view, no copy
+            # Hand the chunk's PCM to the recognizer directly, no temp WAV round-trip
+            audio_data = sr.AudioData(chunk.tobytes(), SAMPLE_RATE, SAMPLE_WIDTH)
+            chunks.append((i / SAMPLE_RATE, len(chunk) / SAMPLE_RATE, audio_data))  # Store start time and duration with chunk
+        
+        # Each recognition is a network round-trip, so send the chunks concurrently.
+        # map() yields results in chunk order, which keeps the subtitles in sequence.
+        with ThreadPoolExecutor(max_workers=RECOGNITION_WORKERS) as executor:
+            texts = list(executor.map(lambda c: _safe_recognize(recognizer, c[2]), chunks))
+        
+        # Split long text into smaller subtitle segments (max 10 words per subtitle),
+        # collecting each batch's word offsets so the timing can be done in one numpy pass
+        words_per_subtitle = 10
+        batch_texts = []
+        batch_chunks = []  # Index of the chunk each batch came from
+        batch_offsets = []  # (first word, one past last word, words in chunk)
+        
+        for chunk_index, text in enumerate(texts):
+            words = text.split()  # Chunks with no recognized speech yield no batches
+            
+            for j in range(0, len(words), words_per_subtitle):
+                word_batch = words[j:j + words_per_subtitle]
+                batch_texts.append(' '.join(word_batch))
+                batch_chunks.append(chunk_index)
+                batch_offsets.append((j, j + len(word_batch), len(words)))
         
         subtitles = []
-        subtitle_index = 1
         
-        for start_time, chunk in chunks:
-            # Export chunk to temporary file
-            chunk_path = output_dir / f"chunk_temp.wav"
-            chunk.export(str(chunk_path), format="wav")
+        if batch_texts:
+            chunk_starts = np.array([c[0] for c in chunks])[batch_chunks]
+            chunk_durations = np.array([c[1] for c in chunks])[batch_chunks]
+            offsets = np.array(batch_offsets, dtype=np.float64)
             
-            # Recognize speech in chunk
-            with sr.AudioFile(str(chunk_path)) as source:
-                audio_data = recognizer.record(source)
-                try:
-                    text = recognizer.recognize_google(audio_data)
-                    
-                    if text.strip():  # Only add if there's actual text
-                        # Calculate end time for this chunk
-                        chunk_duration = len(chunk) / 1000.0
-                        end_time = min(start_time + chunk_duration, total_duration)
-                        
-                        # Split long text into smaller subtitle segments (max 10 words per subtitle)
-                        words = text.split()
-                        words_per_subtitle = 10
-                        
-                        for j in range(0, len(words), words_per_subtitle):
-                            word_batch = words[j:j + words_per_subtitle]
-                            subtitle_text = ' '.join(word_batch)
-                            
-                            # Calculate proportional timing for this word batch
-                            batch_start = start_time + (j / len(words)) * chunk_duration
-                            batch_end = start_time + ((j + len(word_batch)) / len(words)) * chunk_duration
-                            batch_end = min(batch_end, end_time)
-                            
-                            subtitles.append({
-                                'index': subtitle_index,
-                                'start': format_timestamp(batch_start),
-                                'end': format_timestamp(batch_end),
-                                'text': subtitle_text
-                            })
-                            subtitle_index += 1
-                    
-                except sr.UnknownValueError:
-                    # Speech not recognized in this chunk, skip
-                    pass
-                except sr.RequestError as e:
-                    print(f"Could not request results from Google Speech Recognition; {e}")
+            # Calculate proportional timing for every word batch, capped at the chunk's end
+            batch_starts = chunk_starts + (offsets[:, 0] / offsets[:, 2]) * chunk_durations
+            batch_ends = chunk_starts + (offsets[:, 1] / offsets[:, 2]) * chunk_durations
+            batch_ends = np.minimum(batch_ends, np.minimum(chunk_starts + chunk_durations, total_duration))
             
-            # Clean up chunk file
-            if chunk_path.exists():
-                chunk_path.unlink()
-        
-        # Write SRT file
-        with open(srt_path, "w", encoding="utf-8") as f:
-            for sub in subtitles:
-                f.write(f"{sub['index']}\n")
-                f.write(f"{sub['start']} --> {sub['end']}\n")
-                f.write(f"{sub['text']}\n\n")
+            for subtitle_index, (subtitle_text, batch_start, batch_end) in enumerate(
+                zip(batch_texts, format_timestamps(batch_starts), format_timestamps(batch_ends)), start=1
+            ):
+                subtitles.append({
+                    'index': subtitle_index,
+                    'start': batch_start,
+                    'end': batch_end,
+                    'text': subtitle_text
+                })
         
-        # If no subtitles generated, create a default one
-        if not subtitles:
-            with open(srt_path, "w", encoding="utf-8") as f:
-                f.write("1\n")
-                f.write("00:00:00,000 --> 00:00:05,000\n")
-                f.write("No speech detected in video\n\n")
+        # Write SRT file in one go
+        if subtitles:
+            srt_path.write_text(
+                "".join(f"{sub['index']}\n{sub['start']} --> {sub['end']}\n{sub['text']}\n\n" for sub in subtitles),
+                encoding="utf-8"
+            )
+        else:
+            # If no subtitles generated, create a default one
+            srt_path.write_text("1\n00:00:00,000 --> 00:00:05,000\nNo speech detected in video\n\n", encoding="utf-8")
                 
     except Exception as e:
         # If anything fails, create error subtitle
@@ -109,14 +166,17 @@ def generate_subtitles(audio_path: Path, output_dir: Path) -> Path:
     return srt_path
 
 
-def format_timestamp(seconds: float) -> str:
-    """Convert seconds to SRT timestamp format (HH:MM:SS,mmm)"""
-    hrs = int(seconds // 3600)
-    mins = int((seconds % 3600) // 60)
-    secs = seconds % 60
-    millis = int((secs % 1) * 1000)
-    secs = int(secs)
-    return f"{hrs:02d}:{mins:02d}:{secs:02d},{millis:03d}"
+def format_timestamps(seconds: np.ndarray) -> list[str]:
+    """Convert an array of seconds to SRT timestamp format (HH:MM:SS,mmm)"""
+    # Split whole milliseconds with integer divmod, avoiding float % per stamp
+    millis = np.floor(seconds * 1000).astype(np.int64)
+    secs, millis = np.divmod(millis, 1000)
+    mins, secs = np.divmod(secs, 60)
+    hrs, mins = np.divmod(mins, 60)
+    return [
+        f"{h:02d}:{m:02d}:{s:02d},{ms:03d}"
+        for h, m, s, ms in zip(hrs.tolist(), mins.tolist(), secs.tolist(), millis.tolist())
+    ]
 
 
 def burn_subtitles(video_path: Path, subtitle_path: Path, output_dir: Path, font_size: int = 24, font_color: str = "#FFFFFF") -> Path:
@@ -135,16 +195,25 @@ def burn_subtitles(video_path: Path, subtitle_path: Path, output_dir: Path, font
     
     print(f"FFmpeg filter: {subtitle_filter}")
     
+    if VIDEO_ENCODER == "h264_nvenc":
+        # Subtitles are still rendered on the CPU, NVENC takes the frames from there
+        encoder_options = {"vcodec": "h264_nvenc", "preset": "p1", "cq": 23}
+    else:
+        encoder_options = {
+            "vcodec": "libx264",
+            "preset": "ultrafast",  # Faster encoding
+            "crf": 23,  # Quality setting
+            "threads": 0  # Use every core
+        }
+    
     try:
         (
             ffmpeg.input(str(video_path))
             .output(
                 str(output_path),
                 vf=subtitle_filter,
-                vcodec="libx264",
                 acodec="aac",
-                preset="ultrafast",  # Faster encoding
-                crf=23  # Quality setting
+                **encoder_options
             )
             .overwrite_output()
             .run(capture_stdout=True, capture_stderr=True)
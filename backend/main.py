@@ -1,13 +1,21 @@
-from datetime import datetime, timedelta
+from collections import OrderedDict
+from itertools import islice
+import re
 import shutil
+import threading
+import time
 from apscheduler.schedulers.background import BackgroundScheduler
-from caption_utils import extract_audio, generate_subtitles, burn_subtitles
+from caption_utils import generate_subtitles, burn_subtitles, open_recognition_cache, purge_recognition_cache
 from fastapi import FastAPI, UploadFile, File, Header, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import FileResponse
 from pathlib import Path
+from tempfile import SpooledTemporaryFile
 import uuid
 import os
+import sys
+import aiofiles
 
 app = FastAPI()
 
@@ -31,18 +39,86 @@ app.add_middleware(
 
 TEMP_DIR = Path("temp")
 TEMP_DIR.mkdir(exist_ok=True)
+# Kept outside TEMP_DIR so no session-relative path can reach the shared cache
+open_recognition_cache(Path(os.getenv("RECOGNITION_CACHE_PATH", "recognition_cache.db")))
+
+SESSION_EXPIRY_MINUTES = 30
+
+# Captioned video jobs: job_id -> status, plus output_file or detail once finished
+JOBS: dict[str, dict] = {}
+
+# Last activity per session, least recently used first, so expiry only looks at the head
+SESSIONS: OrderedDict[str, float] = OrderedDict()
+sessions_lock = threading.Lock()
+
+# Pick up session folders left over from a previous run
+for folder in sorted((f for f in TEMP_DIR.iterdir() if f.is_dir()), key=lambda f: f.stat().st_mtime):
+    SESSIONS[folder.name] = folder.stat().st_mtime
 
 # File size limit: 20 MB for free tier performance
 MAX_FILE_SIZE = 20 * 1024 * 1024  # 20 MB in bytes
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024  # 8 MB per read/write
+
+# One SRT block: index, "start --> end" line, then text up to the next blank line
+SRT_BLOCK = re.compile(r"(\d+)\n((\S+) --> \S+)\n(.+?)(?=\n\n|\n*\Z)", re.S)
+
+
+class VideoFileResponse(FileResponse):
+    # Stream downloads in 1 MB reads instead of Starlette's 64 KB default
+    chunk_size = 1024 * 1024
 
 
 def get_session_dir(session_id: str) -> Path:
-    safe_id = session_id.replace("/", "")
+    # The frontend generates ids with crypto.randomUUID(), anything else could escape TEMP_DIR
+    try:
+        safe_id = str(uuid.UUID(session_id))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid session id.")
+    if safe_id != session_id.lower():
+        raise HTTPException(status_code=400, detail="Invalid session id.")
+    
     session_path = TEMP_DIR / safe_id
-    session_path.mkdir(exist_ok=True)
+    
+    # Create the folder under the lock so expiry can't delete it between mkdir and the touch
+    with sessions_lock:
+        session_path.mkdir(exist_ok=True)
+        SESSIONS[safe_id] = time.time()
+        SESSIONS.move_to_end(safe_id)
+    
     return session_path
 
 
+def get_session_file(session_folder: Path, filename: str) -> Path:
+    # Only plain file names inside the session folder, no separators or ".." components
+    if not filename or filename in (".", "..") or Path(filename).name != filename:
+        raise HTTPException(status_code=400, detail="Invalid file name.")
+    
+    file_path = session_folder / filename
+    if file_path.resolve().parent != session_folder.resolve():
+        raise HTTPException(status_code=400, detail="Invalid file name.")
+    
+    return file_path
+
+
+def copy_upload(src: SpooledTemporaryFile, dest: Path, size: int) -> None:
+    """Copy a spooled upload to dest with sendfile(2), keeping the bytes in the kernel"""
+    # Uploads under the spool limit (1 MB) live in memory, rollover() writes them to a
+    # temp file first so there is an fd to send from. That costs one extra write for
+    # small files, large ones are already on disk and rollover() is a no-op.
+    src.rollover()
+    
+    with open(dest, "wb") as out_file:
+        offset = 0
+        while offset < size:
+            sent = os.sendfile(out_file.fileno(), src.fileno(), offset, size - offset)
+            if sent == 0:
+                break
+            offset += sent
+    
+    if offset < size:
+        raise OSError(f"Upload copy stopped after {offset} of {size} bytes")
+
+
 @app.get("/health")
 def health_check():
     return {"status": "ok", "message": "Backend is running"}
@@ -76,9 +152,18 @@ async def upload_video(
     video_uuid = str(uuid.uuid4())
     saved_path = session_folder / f"{video_uuid}{ext}"
 
-    with open(saved_path, "wb") as out_file:
-        while chunk := await file.read(1024 * 1024):
-            out_file.write(chunk)
+    # On Linux (the deploy target) sendfile replaces the aiofiles loop below entirely
+    if sys.platform.startswith("linux"):
+        try:
+            await run_in_threadpool(copy_upload, file.file, saved_path, file_size)
+        except OSError as e:
+            saved_path.unlink(missing_ok=True)
+            print(f"Error saving upload: {str(e)}")
+            raise HTTPException(status_code=500, detail="Failed to save uploaded video.")
+    else:
+        async with aiofiles.open(saved_path, "wb") as out_file:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                await out_file.write(chunk)
     
     print(f"Video uploaded: {saved_path.name} ({file_size / (1024 * 1024):.2f} MB)")
 
@@ -96,32 +181,27 @@ def gneerate_captions(
     ):
 
         session_folder = get_session_dir(session_id)
-        video_path = session_folder / video_filename
+        video_path = get_session_file(session_folder, video_filename)
 
         if not video_path.exists():
             raise HTTPException(
                 status_code=404, detail="Video not found for this session."
             )
 
-        audio_path = extract_audio(video_path, session_folder)
-
-        srt_path = generate_subtitles(audio_path, session_folder)
+        srt_path = generate_subtitles(video_path, session_folder)
         
         # Read and parse subtitles for preview
         subtitles = []
         try:
-            with open(srt_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-                blocks = content.strip().split('\n\n')
-                for block in blocks:
-                    lines = block.split('\n')
-                    if len(lines) >= 3:
-                        subtitles.append({
-                            'index': lines[0],
-                            'time': lines[1],
-                            'start': lines[1].split(' --> ')[0],
-                            'text': ' '.join(lines[2:])
-                        })
+            content = srt_path.read_text(encoding='utf-8')
+            # Only the preview is needed, so stop matching after the first 50 blocks
+            for match in islice(SRT_BLOCK.finditer(content), 50):
+                subtitles.append({
+                    'index': match.group(1),
+                    'time': match.group(2),
+                    'start': match.group(3),
+                    'text': match.group(4).replace('\n', ' ')
+                })
         except:
             pass
 
@@ -129,11 +209,11 @@ def gneerate_captions(
             "status": "ok",
             "message": "Subtitles generated successfully.",
             "subtitle_file": srt_path.name,
-            "subtitles": subtitles[:50]  # Return first 50 for preview
+            "subtitles": subtitles  # First 50 for preview
         }
         
         
-@app.post("/generate-captioned-video")
+@app.post("/generate-captioned-video", status_code=202)
 def generate_captioned_video(
     session_id: str = Header(..., alias="X-Session-Id"),
     video_filename: str = Header(..., alias="X-Video-Filename"),
@@ -144,8 +224,8 @@ def generate_captioned_video(
     print(f"Generating captioned video: session={session_id}, video={video_filename}, font_size={font_size}, color={font_color}")
     
     session_folder = get_session_dir(session_id)
-    video_path = session_folder / video_filename
-    subtitle_path = session_folder / subtitle_filename
+    video_path = get_session_file(session_folder, video_filename)
+    subtitle_path = get_session_file(session_folder, subtitle_filename)
     
     if not video_path.exists():
         print(f"Video not found: {video_path}")
@@ -155,18 +235,49 @@ def generate_captioned_video(
         print(f"Subtitle not found: {subtitle_path}")
         raise HTTPException(status_code=404, detail="Subtitle file not found.")
     
+    # Encoding can take minutes, so hand it to the scheduler's worker pool and let the client poll
+    job_id = str(uuid.uuid4())
+    JOBS[job_id] = {"status": "processing", "session_id": session_folder.name}
+    scheduler.add_job(
+        run_burn_job,
+        args=(job_id, video_path, subtitle_path, session_folder, font_size, font_color),
+        id=job_id,
+        misfire_grace_time=None  # Run even if every worker is busy when it comes due
+    )
+    
+    return {
+        "status": "ok",
+        "message": "Captioned video generation started.",
+        "job_id": job_id
+    }
+
+
+def run_burn_job(job_id: str, video_path: Path, subtitle_path: Path, session_folder: Path, font_size: int, font_color: str):
     try:
         output_video = burn_subtitles(video_path, subtitle_path, session_folder, font_size, font_color)
         print(f"Video generated successfully: {output_video}")
-        
-        return {
-            "status": "ok",
-            "message": "Captioned video generated successfully.",
-            "output_file": output_video.name
-        }
+        result = {"status": "done", "output_file": output_video.name}
     except Exception as e:
         print(f"Error generating captioned video: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Video processing failed: {str(e)}")
+        result = {"status": "error", "detail": f"Video processing failed: {str(e)}"}
+    
+    # Give the user a full expiry window from now to download the result
+    with sessions_lock:
+        if session_folder.name in SESSIONS:
+            SESSIONS[session_folder.name] = time.time()
+            SESSIONS.move_to_end(session_folder.name)
+    
+    if job := JOBS.get(job_id):
+        job.update(result)
+
+
+@app.get("/status/{job_id}")
+def job_status(job_id: str):
+    job = JOBS.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    
+    return {key: value for key, value in job.items() if key != "session_id"}
     
 @app.get("/download")
 def download_video(
@@ -175,27 +286,50 @@ def download_video(
 ):
     
     session_folder = get_session_dir(session_id)
-    file_path = session_folder / filename
+    file_path = get_session_file(session_folder, filename)
     if not file_path.exists():
         raise HTTPException(status_code=404, detail="File not found.")
     
-    return FileResponse(
+    return VideoFileResponse(
         file_path,
         media_type="video/mp4",
-        filename=filename
+        filename=filename,
+        stat_result=file_path.stat()
     )
     
-SESSION_EXPIRY_MINUTES = 30
-
 def delete_expired_session():
-    now = datetime.now()
-    
-    for folder in TEMP_DIR.iterdir():
-        if folder.is_dir():
-            folder_age = now - datetime.fromtimestamp(folder.stat().st_mtime)
-            if folder_age > timedelta(minutes=SESSION_EXPIRY_MINUTES):
-                shutil.rmtree(folder)
-                print(f"Deleted expired session: {folder}")
+    cutoff = time.time() - SESSION_EXPIRY_MINUTES * 60
+    purge_recognition_cache(SESSION_EXPIRY_MINUTES * 60)
+    
+    while True:
+        with sessions_lock:
+            if not SESSIONS:
+                break
+            session_id, last_active = next(iter(SESSIONS.items()))
+            if last_active > cutoff:
+                break
+            
+            # ffmpeg is still writing into the folder, check again next round
+            if any(job["session_id"] == session_id and job["status"] == "processing" for job in list(JOBS.values())):
+                SESSIONS[session_id] = time.time()
+                SESSIONS.move_to_end(session_id)
+                continue
+            
+            del SESSIONS[session_id]
+            
+            # Only rename under the lock, so a request touching the session right after gets a
+            # fresh folder, and the slow rmtree below doesn't hold up get_session_dir
+            folder = TEMP_DIR / session_id
+            tombstone = None
+            if folder.resolve().parent == TEMP_DIR.resolve() and folder.is_dir():
+                tombstone = folder.rename(TEMP_DIR / f".expired-{uuid.uuid4().hex}")
+        
+        if tombstone is not None:
+            shutil.rmtree(tombstone, ignore_errors=True)
+            print(f"Deleted expired session: {folder}")
+        
+        for job_id in [j for j, job in list(JOBS.items()) if job["session_id"] == session_id]:
+            del JOBS[job_id]
 
 scheduler = BackgroundScheduler()
 scheduler.add_job(delete_expired_session, "interval", minutes=30)
@@ -101,6 +101,28 @@ export default function Home() {
     }
   }
 
+  async function waitForJob(jobId: string) {
+    const deadline = Date.now() + 300000; // 5 minutes timeout
+
+    while (Date.now() < deadline) {
+      await new Promise((resolve) => setTimeout(resolve, 3000));
+
+      try {
+        const res = await axios.get(`${API_URL}/status/${jobId}`, { timeout: 10000 });
+        if (res.data.status !== "processing") return res.data;
+      } catch (err) {
+        // The backend no longer knows this job (e.g. it restarted), polling won't help
+        if (axios.isAxiosError(err) && err.response?.status === 404) {
+          return { status: "error", detail: "Job not found." };
+        }
+        // Otherwise the job keeps running on the server, so a failed poll is just retried
+        console.warn("Status check failed, retrying:", err);
+      }
+    }
+
+    return { status: "timeout" };
+  }
+
   async function handleGenerateFinalVideo(){
     const sessionId = getSessionId();
 
@@ -120,13 +142,20 @@ export default function Home() {
               "X-Font-Size": fontSize.toString(),
               "X-Font-Color": fontColor,
             },
-            timeout: 300000, // 5 minutes timeout
+            timeout: 30000, // Only queues the job, encoding is polled below
           }
         );
 
-        setFinalVideo(res.data.output_file);
-        setProgress(4);
-        setMessage("Captioned video ready! Click below to download.");
+        const job = await waitForJob(res.data.job_id);
+        if (job.status === "done") {
+          setFinalVideo(job.output_file);
+          setProgress(4);
+          setMessage("Captioned video ready! Click below to download.");
+        } else if (job.status === "error") {
+          setMessage(`❌ Error: ${job.detail}`);
+        } else {
+          setMessage("❌ Timeout! Try a shorter video or wait for backend to wake up.");
+        }
   } catch (err: any) {
     if (err.code === 'ECONNABORTED') {
       setMessage("❌ Timeout! Try a shorter video or wait for backend to wake up.");